@@ -175,6 +175,15 @@ def decode_jwt_token(authorization: str | None = Header(...)) -> dict[str, Any]:
     return credentials
 
 
+def get_token_payload(request: Request) -> dict[str, Any]:
+    # The header is read from the request rather than declared as a Header parameter so that
+    # it doesn't appear as an input in the OpenAPI spec.
+    return decode_jwt_token(request.headers.get("authorization"))
+
+
+TokenPayloadDep = Annotated[dict[str, Any], Depends(get_token_payload)]
+
+
 def workspace_authz(
     workspace: str, token_payload: dict[str, Any], require_owner: bool = False, allow_hub_admin: bool = False
 ) -> str:
@@ -219,7 +228,7 @@ def account_authz(account_id: UUID, token_payload: dict[str, Any], allow_hub_adm
     summary="Get resource consumption data for a workspace",
 )
 def get_workspace_usage_data(
-    request: Request,
+    token_payload: TokenPayloadDep,
     session: SessionDep,
     response: Response,
     workspace: Annotated[
@@ -286,12 +295,6 @@ def get_workspace_usage_data(
     never be aggregated across day boundaries (midnight UTC).
     """
 
-    # Get the authorization header from the request
-    authorization = request.headers.get("authorization")
-
-    # Decode the JWT token
-    token_payload = decode_jwt_token(authorization)
-
     # Check workspace authorization
     workspace = workspace_authz(workspace, token_payload, allow_hub_admin=True)
 
@@ -321,7 +324,7 @@ def get_workspace_usage_data(
     summary="Get resource consumption data for all workspaces in a billing account",
 )
 def get_account_usage_data(
-    request: Request,
+    token_payload: TokenPayloadDep,
     session: SessionDep,
     response: Response,
     account_id: Annotated[
@@ -392,12 +395,6 @@ def get_account_usage_data(
     never be aggregated across day boundaries (midnight UTC).
     """
 
-    # Get the authorization header from the request
-    authorization = request.headers.get("authorization")
-
-    # Decode the JWT token
-    token_payload = decode_jwt_token(authorization)
-
     # Check authorization
     account_id = account_authz(account_id, token_payload, allow_hub_admin=True)
 
@@ -4,14 +4,23 @@ from typing import TextIO
 
 import yaml
 from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 from yaml.error import YAMLError
 
 from accounting_service import models
 from accounting_service.db_settings import connect_args, get_db_url
 
+# The libyaml-based loader is much faster but PyYAML can be built without it.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 engine = create_engine(get_db_url(), connect_args=connect_args)
 
+# All sessions should be created from this so that tests can bind them to a test transaction.
+SessionLocal = sessionmaker(bind=engine)
+
 
 def create_db_and_tables() -> None:
     with engine.begin() as conn:
@@ -24,7 +33,7 @@ def drop_tables() -> None:
 
 
 def get_session() -> Iterator[Session]:
-    with Session(engine) as session:
+    with SessionLocal() as session:
         yield session
 
 
@@ -43,14 +52,14 @@ def insert_configuration(config: TextIO) -> None:
         price: 12.34
     """
     try:
-        config_obj = yaml.safe_load(config)
+        config_obj = yaml.load(config, Loader=SafeLoader)
         if not isinstance(config_obj, dict):
             raise YAMLError("Expected a YAML dictionary in config file - check the format")
     except YAMLError:
         logging.fatal("accounting-service configuration file is not valid - check the format")
         raise
 
-    with Session(engine) as session:
+    with SessionLocal() as session:
         for item in config_obj.get("items", []):
             models.BillingItem.upsert_configured_item(session, item)
 
@@ -1,5 +1,6 @@
 import logging
 import uuid
+from collections import OrderedDict
 from collections.abc import Sequence
 from datetime import UTC, datetime, timedelta
 from uuid import UUID
@@ -7,12 +8,36 @@ from uuid import UUID
 from eodhp_utils.messagers import Messager, PulsarJSONMessager
 from eodhp_utils.pulsar import messages
 from sqlalchemy.exc import IntegrityError, OperationalError
-from sqlalchemy.orm import Session
 
 from accounting_service import db, models
 
+# How many recently recorded message UUIDs each ingester remembers.
+RECORDED_UUIDS_CACHE_SIZE = 100_000
+
 
 class DBIngester:
+    def __init__(self, *args: object, **kwargs: object) -> None:
+        super().__init__(*args, **kwargs)
+
+        # UUIDs of messages we know are already in the DB, least recently seen first. Pulsar
+        # redelivers messages so this lets us drop many duplicates without a DB round trip.
+        # Entries are only added after a successful commit.
+        self._recorded_uuids: OrderedDict[UUID, None] = OrderedDict()
+
+    def _is_recorded(self, msg_uuid: UUID) -> bool:
+        if msg_uuid in self._recorded_uuids:
+            self._recorded_uuids.move_to_end(msg_uuid)
+            return True
+
+        return False
+
+    def _mark_recorded(self, msg_uuid: UUID) -> None:
+        self._recorded_uuids[msg_uuid] = None
+        self._recorded_uuids.move_to_end(msg_uuid)
+
+        if len(self._recorded_uuids) > RECORDED_UUIDS_CACHE_SIZE:
+            self._recorded_uuids.popitem(last=False)
+
     def is_temporary_error(self, e: Exception) -> bool:
         if isinstance(e, OperationalError):
             return True
@@ -20,7 +45,7 @@ class DBIngester:
         return False
 
     def _add_observed_sku(self, msg: messages.BillingEvent | messages.BillingResourceConsumptionRateSample) -> None:
-        with Session(db.engine) as session:
+        with db.SessionLocal() as session:
             models.BillingItem.ensure_sku_exists(session, str(msg.sku))
             session.commit()
 
@@ -36,6 +61,10 @@ class AccountingIngesterMessager(DBIngester, PulsarJSONMessager[messages.Billing
     """
 
     def process_payload(self, obj: messages.BillingEvent) -> Sequence[Messager.Action]:
+        if self._is_recorded(UUID(str(obj.uuid))):
+            logging.info("Received duplicate BillingEvent uuid %s", obj.uuid)
+            return []
+
         try:
             uuid = self._try_record_event(obj)
         except IntegrityError:
@@ -59,16 +88,17 @@ class AccountingIngesterMessager(DBIngester, PulsarJSONMessager[messages.Billing
         return []
 
     def _try_record_event(self, bemsg: messages.BillingEvent) -> UUID | None:
-        with Session(db.engine) as session:
+        with db.SessionLocal() as session:
             uuid = models.BillingEvent.insert_from_message(session, bemsg)
             session.commit()
 
+        self._mark_recorded(UUID(str(bemsg.uuid)))
         return uuid
 
 
 class WorkspaceSettingsIngesterMessager(DBIngester, PulsarJSONMessager[messages.WorkspaceSettings, bytes]):
     def process_payload(self, obj: messages.WorkspaceSettings) -> Sequence[Messager.Action]:
-        with Session(db.engine) as session:
+        with db.SessionLocal() as session:
             recorded = models.WorkspaceAccount.record_mapping(session, UUID(str(obj.account)), str(obj.name))
             session.commit()
 
@@ -109,6 +139,10 @@ class ConsumptionSampleRateIngesterMessager(
         return []
 
     def _record_event(self, msg: messages.BillingResourceConsumptionRateSample) -> None:
+        if self._is_recorded(UUID(str(msg.uuid))):
+            logging.info("Received duplicate %s uuid %s", type(msg), msg.uuid)
+            return
+
         try:
             uuid = self._try_record_event(msg)
         except IntegrityError:
@@ -127,10 +161,11 @@ class ConsumptionSampleRateIngesterMessager(
             logging.info("Received duplicate %s uuid %s", type(msg), msg.uuid)
 
     def _try_record_event(self, msg: messages.BillingResourceConsumptionRateSample) -> UUID | None:
-        with Session(db.engine) as session:
+        with db.SessionLocal() as session:
             uuid = models.BillableResourceConsumptionRateSample.insert_from_message(session, msg)
             session.commit()
 
+        self._mark_recorded(UUID(str(msg.uuid)))
         return uuid
 
     @staticmethod
@@ -150,7 +185,7 @@ class ConsumptionSampleRateIngesterMessager(
             upto,
         )
 
-        with Session(db.engine) as session:
+        with db.SessionLocal() as session:
             item = models.BillingItem.find_billing_item(session, sku=sku)
             assert item is not None  # _record_event would have failed without it
 
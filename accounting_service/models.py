@@ -12,31 +12,41 @@ import eodhp_utils.pulsar.messages
 from sqlalchemy import (
     TIMESTAMP,
     CheckConstraint,
+    ColumnElement,
     CursorResult,
     ForeignKey,
     Index,
     Result,
+    Select,
     Uuid,
-    and_,
     func,
     or_,
     select,
     text,
+    tuple_,
     union,
     update,
 )
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import (
     DeclarativeBase,
+    InstrumentedAttribute,
     Mapped,
     Session,
     aliased,
+    contains_eager,
+    joinedload,
+    load_only,
     mapped_column,
     relationship,
 )
+from sqlalchemy.orm.util import AliasedClass
 
 from accounting_service import db_settings
 
+# A consumption rate at a number of seconds after the start of an interval.
+RateTime = namedtuple("RateTime", ["at", "rate"])
+
 
 class Base(DeclarativeBase):
     pass
@@ -112,6 +122,27 @@ class BillingItem(Base):
         result = session.execute(query).first()
         return result[0] if result else None
 
+    @classmethod
+    def find_billing_item_cached(cls, session: Session, sku: str) -> "BillingItem | None":
+        """
+        This is find_billing_item but remembers the BillingItems found for the rest of the session.
+        It's for sessions applying a configuration, where BillingItems are only added or changed
+        by upsert_configured_item.
+        """
+        items_by_sku = cls._items_by_sku(session)
+        if sku not in items_by_sku:
+            item_obj = cls.find_billing_item(session, sku)
+            if not item_obj:
+                return None
+
+            items_by_sku[sku] = item_obj
+
+        return items_by_sku[sku]
+
+    @staticmethod
+    def _items_by_sku(session: Session) -> dict[str, "BillingItem"]:
+        return session.info.setdefault("billing_items_by_sku", {})
+
     @classmethod
     def ensure_sku_exists(cls, session: Session, sku: str) -> Self | None:
         """
@@ -141,7 +172,7 @@ class BillingItem(Base):
         such as a YAML configuration file. 'item' should have fields 'sku', 'name' and 'unit'.
         An item will be inserted if the SKU isn't known, otherwise name and unit will be updated.
         """
-        item_obj = cls.find_billing_item(session, item["sku"])
+        item_obj = cls.find_billing_item_cached(session, item["sku"])
         if item_obj:
             if "name" in item:
                 item_obj.name = item["name"]
@@ -150,6 +181,7 @@ class BillingItem(Base):
         else:
             item_obj = BillingItem(**item)
             session.add(item_obj)
+            cls._items_by_sku(session)[item_obj.sku] = item_obj
 
 
 class BillingItemPrice(Base):
@@ -234,7 +266,7 @@ class BillingItemPrice(Base):
         will replace it at that time, or must exactly match an existing configured price, in
         which case its price will be updated.
         """
-        item_obj = BillingItem.find_billing_item(session, price["sku"])
+        item_obj = BillingItem.find_billing_item_cached(session, price["sku"])
         if not item_obj:
             logging.error("Failed to find item %s when configuring price", price["sku"])
             raise ValueError(f"Attempt to add price for unknown SKU {price['sku']}")
@@ -305,7 +337,9 @@ class BillingEvent(Base):
     event_start: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
     event_end: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True))
     item_id: Mapped[UUID] = mapped_column(ForeignKey(BillingItem.uuid))
-    item: Mapped["BillingItem"] = relationship(foreign_keys=item_id)
+
+    # Callers must explicitly eager-load this (eg, with joinedload) to avoid N+1 queries.
+    item: Mapped["BillingItem"] = relationship(foreign_keys=item_id, lazy="raise_on_sql")
     user: Mapped[UUID | None]  # This is None for, for example, workspace storage.
     workspace: Mapped[str]
     quantity: Mapped[float]  # The units involved are defined in the BillingItem
@@ -329,6 +363,14 @@ class BillingEvent(Base):
             "workspace",
             "event_start",
         ),
+        # This matches the leading columns of the find_billing_events sort order for queries
+        # which aren't restricted to one workspace.
+        Index(
+            "billingevent_eventstart_eventend_workspace_index",
+            "event_start",
+            "event_end",
+            "workspace",
+        ),
         CheckConstraint("event_start <= event_end"),
     )
 
@@ -361,6 +403,7 @@ class BillingEvent(Base):
         after: UUID | None = None,
         limit: int = 5_000,
         time_aggregation: str | None = None,
+        columns: Sequence[InstrumentedAttribute[Any]] | None = None,
     ) -> Iterator[Self]:
         """
         Find and return BillingEvents matching some criteria.
@@ -369,6 +412,67 @@ class BillingEvent(Base):
 
         time_aggregation may be 'day' or 'month' to provide daily or monthly totals for each
         SKU+workspace pair.
+
+        If `columns` is given, such as [BillingEvent.uuid], only those columns and the item are
+        loaded. Accessing any other column raises an error rather than running a query per
+        BillingEvent. This can't be combined with time_aggregation.
+        """
+        query = cls.find_billing_events_stmt(
+            session, workspace, account, start, end, after, limit, time_aggregation, columns
+        )
+        return map(lambda r: r[0], session.execute(query))
+
+    @classmethod
+    def find_billing_events_stmt(
+        cls,
+        session: Session,
+        workspace: str | None = None,
+        account: UUID | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        after: UUID | None = None,
+        limit: int = 5_000,
+        time_aggregation: str | None = None,
+        columns: Sequence[InstrumentedAttribute[Any]] | None = None,
+    ) -> Select[tuple["BillingEvent"]]:
+        """
+        Build the SELECT used by find_billing_events, without executing it. The session is only
+        used to look up the `after` BillingEvent.
+        """
+        if columns is not None and time_aggregation is not None:
+            raise ValueError("columns can't be used with time_aggregation")
+
+        billingevent_src = cls._billing_event_source(time_aggregation)
+
+        all_billing_events = (
+            select(billingevent_src)
+            .join(BillingItem, BillingItem.uuid == billingevent_src.item_id)
+            .options(contains_eager(billingevent_src.item))
+        )
+
+        if columns is not None:
+            all_billing_events = all_billing_events.options(load_only(*columns, raiseload=True))
+
+        # We need a complete and certain order so that the 'after' parameter works.
+        query = all_billing_events.order_by(
+            billingevent_src.event_start,
+            billingevent_src.event_end,
+            billingevent_src.workspace,
+            BillingItem.sku,
+            billingevent_src.uuid,
+        )
+
+        query = query.limit(limit)
+
+        query = query.where(*cls._build_filters(session, billingevent_src, workspace, account, start, end, after))
+
+        return query
+
+    @classmethod
+    def _billing_event_source(cls, time_aggregation: str | None) -> "type[BillingEvent] | AliasedClass[BillingEvent]":
+        """
+        Returns the source of BillingEvent rows to filter, sort and page for the given time
+        aggregation.
         """
         # With no time aggregation we use the raw table as the source of rows to filter, sort,
         # page and return.
@@ -412,78 +516,100 @@ GROUP BY 2, 3, 4, 6
                 cls.quantity,
             )
 
-            billingevent_src = aliased(BillingEvent, select_aggregated_events.subquery())
-        else:
-            billingevent_src = cls
+            return aliased(BillingEvent, select_aggregated_events.subquery())
 
-        all_billing_events = select(billingevent_src).join(BillingItem, BillingItem.uuid == billingevent_src.item_id)
-
-        # We need a complete and certain order so that the 'after' parameter works.
-        query = all_billing_events.order_by(
-            billingevent_src.event_start,
-            billingevent_src.event_end,
-            billingevent_src.workspace,
-            BillingItem.sku,
-            billingevent_src.uuid,
-        )
+        return cls
 
-        query = query.limit(limit)
+    @classmethod
+    def _build_filters(
+        cls,
+        session: Session,
+        billingevent_src: "type[BillingEvent] | AliasedClass[BillingEvent]",
+        workspace: str | None = None,
+        account: UUID | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        after: UUID | None = None,
+    ) -> list[ColumnElement[bool]]:
+        """
+        Returns the WHERE conditions shared by find_billing_events_stmt and
+        find_billing_events_count. The `after` condition refers to BillingItem, so the query must
+        join it.
+        """
+        filters: list[ColumnElement[bool]] = []
 
         if workspace is not None:
-            query = query.where(billingevent_src.workspace == workspace)
+            filters.append(billingevent_src.workspace == workspace)
 
         if account is not None:
-            query = query.join(WorkspaceAccount, WorkspaceAccount.workspace == billingevent_src.workspace).where(
-                WorkspaceAccount.account == account
+            filters.append(
+                billingevent_src.workspace.in_(
+                    select(WorkspaceAccount.workspace).where(WorkspaceAccount.account == account)
+                )
             )
 
         if start is not None:
-            query = query.where(billingevent_src.event_start >= start)
+            filters.append(billingevent_src.event_start >= start)
 
         if end is not None:
-            query = query.where(billingevent_src.event_end < end)
+            filters.append(billingevent_src.event_end < end)
 
         if after is not None:
             # This is equivalent to
             #   after_be = session.get(cls, after)
             # but it works when billingevent_src is an alias rather than an ORM class.
             after_be = session.execute(
-                select(billingevent_src).where(billingevent_src.uuid == after)
+                select(billingevent_src)
+                .where(billingevent_src.uuid == after)
+                .options(joinedload(billingevent_src.item, innerjoin=True))
             ).scalar_one_or_none()
 
             if after_be is None:
                 raise AfterBillingEventNotFound(f"No records matching after={after} found")
 
-            query = query.where(
-                billingevent_src.event_start >= after_be.event_start,
-                or_(
-                    (billingevent_src.event_start > after_be.event_start),
-                    and_(
-                        billingevent_src.event_start == after_be.event_start,
-                        billingevent_src.event_end > after_be.event_end,
-                    ),
-                    and_(
-                        billingevent_src.event_start == after_be.event_start,
-                        billingevent_src.event_end == after_be.event_end,
-                        billingevent_src.workspace > after_be.workspace,
-                    ),
-                    and_(
-                        billingevent_src.event_start == after_be.event_start,
-                        billingevent_src.event_end == after_be.event_end,
-                        billingevent_src.workspace == after_be.workspace,
-                        BillingItem.sku > after_be.item.sku,
-                    ),
-                    and_(
-                        billingevent_src.event_start == after_be.event_start,
-                        billingevent_src.event_end == after_be.event_end,
-                        billingevent_src.workspace == after_be.workspace,
-                        BillingItem.sku == after_be.item.sku,
-                        billingevent_src.uuid > after,
-                    ),
-                ),
+            # Keyset paging: everything after after_be in the sort order used by
+            # find_billing_events. The separate event_start condition lets the database use an
+            # index range scan.
+            filters.append(billingevent_src.event_start >= after_be.event_start)
+            filters.append(
+                tuple_(
+                    billingevent_src.event_start,
+                    billingevent_src.event_end,
+                    billingevent_src.workspace,
+                    BillingItem.sku,
+                    billingevent_src.uuid,
+                )
+                > (after_be.event_start, after_be.event_end, after_be.workspace, after_be.item.sku, after_be.uuid)
             )
 
-        return map(lambda r: r[0], session.execute(query))
+        return filters
+
+    @classmethod
+    def find_billing_events_count(
+        cls,
+        session: Session,
+        workspace: str | None = None,
+        account: UUID | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        after: UUID | None = None,
+        time_aggregation: str | None = None,
+    ) -> int:
+        """
+        Returns the number of BillingEvents find_billing_events would return with no limit,
+        without loading them.
+        """
+        billingevent_src = cls._billing_event_source(time_aggregation)
+        filters = cls._build_filters(session, billingevent_src, workspace, account, start, end, after)
+
+        query = (
+            select(func.count())
+            .select_from(billingevent_src)
+            .join(BillingItem, BillingItem.uuid == billingevent_src.item_id)
+            .where(*filters)
+        )
+
+        return session.scalar(query) or 0
 
     @classmethod
     def find_latest_billing_event(
@@ -512,22 +638,43 @@ GROUP BY 2, 3, 4, 6
 
         Deals with duplicated UUIDs by ignoring the second message and returning None.
         """
+        uuids = cls.insert_many_from_messages(session, [msg])
+        return uuids[0] if uuids else None
+
+    @classmethod
+    def insert_many_from_messages(
+        cls, session: Session, msgs: Sequence[eodhp_utils.pulsar.messages.BillingEvent]
+    ) -> list[UUID]:
+        """
+        Adds new BillingEvents to the DB based on Pulsar messages, using a single INSERT.
+
+        Messages with UUIDs already in the DB are ignored. The UUIDs of the BillingEvents added
+        are returned, in no particular order.
+        """
+        if not msgs:
+            return []
+
         result = session.execute(
             insert(cls)
             .values(
-                uuid=UUID(str(msg.uuid)),
-                event_start=datetime_default_to_utc(datetime.fromisoformat(str(msg.event_start))),
-                event_end=datetime_default_to_utc(datetime.fromisoformat(str(msg.event_end))),
-                item_id=select(BillingItem.uuid).where(BillingItem.sku == msg.sku).scalar_subquery(),
-                user=UUID(str(msg.user)) if msg.user else None,
-                workspace=msg.workspace,
-                quantity=msg.quantity,
+                [
+                    {
+                        "uuid": UUID(str(msg.uuid)),
+                        "event_start": datetime_default_to_utc(datetime.fromisoformat(str(msg.event_start))),
+                        "event_end": datetime_default_to_utc(datetime.fromisoformat(str(msg.event_end))),
+                        "item_id": select(BillingItem.uuid).where(BillingItem.sku == msg.sku).scalar_subquery(),
+                        "user": UUID(str(msg.user)) if msg.user else None,
+                        "workspace": msg.workspace,
+                        "quantity": msg.quantity,
+                    }
+                    for msg in msgs
+                ]
             )
             .on_conflict_do_nothing(index_elements=["uuid"])
             .returning(BillingEvent.uuid)
         )
 
-        return result.scalar_one_or_none()
+        return list(result.scalars())
 
     def __repr__(self) -> str:
         return (
@@ -565,7 +712,7 @@ class BillableResourceConsumptionRateSample(Base):
     sample_time: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), index=True)
 
     item_id: Mapped[UUID] = mapped_column(ForeignKey(BillingItem.uuid))
-    item: Mapped["BillingItem"] = relationship(foreign_keys=item_id)
+    item: Mapped["BillingItem"] = relationship(foreign_keys=item_id, lazy="raise_on_sql")
 
     user: Mapped[UUID | None]  # This is None for, for example, workspace storage.
     workspace: Mapped[str]
@@ -589,27 +736,56 @@ class BillableResourceConsumptionRateSample(Base):
             "workspace",
             "sample_time",
         ),
+        # This lets each of the three parts of find_data_for_interval, which are restricted to one
+        # workspace and item, be a range scan in sample_time order (forwards or backwards).
+        Index(
+            "billableresourceconsumptionratesample_workspace_item_time_index",
+            "workspace",
+            "item_id",
+            "sample_time",
+        ),
     )
 
     @classmethod
     def insert_from_message(
         cls, session: Session, msg: eodhp_utils.pulsar.messages.BillingResourceConsumptionRateSample
     ) -> UUID | None:
+        uuids = cls.insert_many_from_messages(session, [msg])
+        return uuids[0] if uuids else None
+
+    @classmethod
+    def insert_many_from_messages(
+        cls, session: Session, msgs: Sequence[eodhp_utils.pulsar.messages.BillingResourceConsumptionRateSample]
+    ) -> list[UUID]:
+        """
+        Adds new samples to the DB based on Pulsar messages, using a single INSERT.
+
+        Messages with UUIDs already in the DB are ignored. The UUIDs of the samples added are
+        returned, in no particular order.
+        """
+        if not msgs:
+            return []
+
         result = session.execute(
             insert(cls)
             .values(
-                uuid=UUID(str(msg.uuid)),
-                sample_time=datetime_default_to_utc(datetime.fromisoformat(str(msg.sample_time))),
-                item_id=(select(BillingItem.uuid).where(BillingItem.sku == msg.sku).scalar_subquery()),
-                user=UUID(str(msg.user)) if msg.user else None,
-                workspace=msg.workspace,
-                rate=msg.rate,
+                [
+                    {
+                        "uuid": UUID(str(msg.uuid)),
+                        "sample_time": datetime_default_to_utc(datetime.fromisoformat(str(msg.sample_time))),
+                        "item_id": select(BillingItem.uuid).where(BillingItem.sku == msg.sku).scalar_subquery(),
+                        "user": UUID(str(msg.user)) if msg.user else None,
+                        "workspace": msg.workspace,
+                        "rate": msg.rate,
+                    }
+                    for msg in msgs
+                ]
             )
             .on_conflict_do_nothing(index_elements=["uuid"])
             .returning(cls.uuid)
         )
 
-        return result.scalar_one_or_none()
+        return list(result.scalars())
 
     @classmethod
     def find_data_for_interval(
@@ -688,8 +864,6 @@ class BillableResourceConsumptionRateSample(Base):
 
             return s0.rate + proportion * (s1.rate - s0.rate)
 
-        RateTime = namedtuple("RateTime", ["at", "rate"])
-
         starting_ratetime = (
             # If no samples exist before the window then it may not have existed yet.
             # To avoid awkward questions, we treat consumption as zero up until the first
@@ -1,57 +1,185 @@
+import copy
+import functools
+import os
+import uuid
 from collections.abc import Iterator
+from contextlib import contextmanager
 from datetime import UTC, datetime
-from unittest.mock import Mock
+from typing import Any, cast
+from unittest.mock import Mock, patch
 
 import pytest
 from eodhp_utils.pulsar import messages
 from faker import Faker
 from fastapi.testclient import TestClient
 from pulsar import Message
-from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from pulsar.schema import Schema
+from sqlalchemy import Connection, Engine, StaticPool, create_engine, insert, text
+from sqlalchemy.orm import Session, sessionmaker
 
-from accounting_service import db
+from accounting_service import db, db_settings, models
 from accounting_service.app.app import app as fastapi_app
+from accounting_service.app.app import get_token_payload
 from accounting_service.ingester.messager import (
     AccountingIngesterMessager,
     WorkspaceSettingsIngesterMessager,
 )
 
+# This is a manual testing script which connects to Pulsar when run.
+collect_ignore = ["send_test_message.py"]
+
 
 @pytest.fixture(scope="session")
-def db_session_factory() -> scoped_session[Session]:
-    """returns a SQLAlchemy scoped session factory"""
+def db_engine() -> Iterator[Engine]:
+    """
+    yields the SQLAlchemy engine used by tests
+
+    With SQLite this is an in-memory database on a single connection, otherwise it's the
+    configured database. Each pytest-xdist worker is a separate process, so with SQLite each
+    worker gets its own database. With other databases each worker uses its own schema.
+    """
+    # This is set by pytest-xdist in its workers. We don't use its worker_id fixture so the tests
+    # still run without the plugin.
+    worker_id = os.environ.get("PYTEST_XDIST_WORKER", "master")
+
+    schema = None
+    if db_settings.is_sqlite():
+        engine = create_engine(
+            "sqlite+pysqlite:///:memory:",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+    elif worker_id == "master":
+        yield db.engine
+        return
+    else:
+        schema = f"test_{worker_id}"
+        with db.engine.begin() as connection:
+            connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
+
+        engine = create_engine(
+            db.engine.url.update_query_dict({"options": f"-c search_path={schema}"}),
+            connect_args=db_settings.connect_args,
+        )
+
+    with patch.object(db, "engine", engine):
+        yield engine
+
+    engine.dispose()
+
+    if schema:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+
+
+@pytest.fixture(scope="session")
+def db_connection(db_engine: Engine) -> Iterator[Connection]:
+    """yields a SQLAlchemy connection in a transaction which is rolled back after all tests"""
     db.drop_tables()
     db.create_db_and_tables()
-    return scoped_session(sessionmaker(bind=db.engine))
+
+    connection = db_engine.connect()
+    transaction = connection.begin()
+
+    yield connection
+
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db_session_factory(db_connection: Connection) -> Iterator[sessionmaker[Session]]:
+    """
+    yields a SQLAlchemy session factory bound to the test connection
+
+    This replaces db.SessionLocal so that the code under test joins the test transaction.
+    Committing these sessions only releases a SAVEPOINT.
+    """
+    factory = sessionmaker(bind=db_connection, join_transaction_mode="create_savepoint")
+    with patch.object(db, "SessionLocal", factory):
+        yield factory
 
 
 @pytest.fixture
-def db_session(db_session_factory: scoped_session[Session]) -> Iterator[Session]:
-    """yields a SQLAlchemy connection which is rollbacked after the test"""
+def db_session(db_connection: Connection, db_session_factory: sessionmaker[Session]) -> Iterator[Session]:
+    """yields a SQLAlchemy session inside a SAVEPOINT which is rolled back after the test"""
+    savepoint = db_connection.begin_nested()
     session_ = db_session_factory()
 
     yield session_
 
-    session_.rollback()
     session_.close()
+    savepoint.rollback()
 
 
-def fake_event_known_times() -> tuple[messages.BillingEvent, datetime, datetime]:
-    faker = Faker()
+# Values for the BillingItem columns, other than the SKU, which tests don't care about.
+DEFAULT_ITEM_KWARGS = {"name": "test", "unit": "GB-h"}
+
+
+@contextmanager
+def module_savepoint_session(
+    db_connection: Connection, db_session_factory: sessionmaker[Session]
+) -> Iterator[Session]:
+    """
+    yields a SQLAlchemy session for seeding data which is shared by the tests in a module
+
+    Use this in a module-scoped fixture which seeds and commits the data and then yields for the
+    tests. Everything is inside a SAVEPOINT which is rolled back afterwards, even if seeding fails.
+    """
+    savepoint = db_connection.begin_nested()
+    try:
+        with db_session_factory() as session:
+            yield session
+    finally:
+        savepoint.rollback()
+
+
+def add_billing_item(session: Session, sku: str) -> None:
+    """This inserts a test BillingItem straight away, so no flush is needed before other sessions use it"""
+    session.execute(insert(models.BillingItem).values(sku=sku, **DEFAULT_ITEM_KWARGS))
+
+
+# One Faker is shared by all tests because creating one is relatively slow.
+FAKER = Faker()
+
+
+@functools.cache
+def _fake_template(klass: type) -> object:
+    return klass.get_fake()
 
+
+def fake_msg[T](klass: type[T], **overrides: object) -> T:
+    """
+    This returns a copy of a fake message of the given type with a new UUID and the given field
+    values. The other fields are the same on every call - use get_fake() if they need to be
+    randomised.
+    """
+    msg = cast(T, copy.copy(_fake_template(klass)))
+    for field, value in {"uuid": str(uuid.uuid4()), **overrides}.items():
+        setattr(msg, field, value)
+
+    return msg
+
+
+def fake_event_known_times() -> tuple[messages.BillingEvent, datetime, datetime]:
     ############# Setup
-    bemsg: messages.BillingEvent = messages.BillingEvent.get_fake()
+    bemsg = fake_msg(messages.BillingEvent)
 
-    start = faker.past_datetime("-30d", tzinfo=UTC)
-    end = start + faker.time_delta("+10m")
+    start = FAKER.past_datetime("-30d", tzinfo=UTC)
+    end = start + FAKER.time_delta("+10m")
     bemsg.event_start = start.isoformat()
     bemsg.event_end = end.isoformat()
 
     return bemsg, start, end
 
 
+@functools.cache
+def _schema_for(klass: type) -> Schema:
+    return klass.get_schema()
+
+
 def msg_to_pulsar_msg(klass: type, inmsg: object) -> Message:
-    schema = klass.get_schema()
+    schema = _schema_for(klass)
 
     testmsg = Mock()
     testmsg.data = Mock(return_value=schema.encode(inmsg))
@@ -69,16 +197,37 @@ def wsmsg_to_pulsar_msg(bemsg: messages.WorkspaceSettings) -> Message:
     return msg_to_pulsar_msg(WorkspaceSettingsIngesterMessager, bemsg)
 
 
+@pytest.fixture(scope="session", autouse=True)
+def mock_token_payload() -> Iterator[dict[str, Any]]:
+    """This replaces JWT decoding in the API with a fixed token payload for all tests"""
+    payload = {
+        "workspaces": ["workspace1", "workspace2"],
+        "workspaces_owned": ["workspace2"],
+        "realm_access": {"roles": ["user", "hub_admin"]},
+    }
+
+    fastapi_app.dependency_overrides[get_token_payload] = lambda: payload
+
+    yield payload
+
+    del fastapi_app.dependency_overrides[get_token_payload]
+
+
+@pytest.fixture(scope="session")
+def _client() -> TestClient:
+    """This supplies a FastAPI test HTTP client shared by all tests"""
+    return TestClient(fastapi_app)
+
+
 @pytest.fixture
-def client(db_session: Session) -> TestClient:
-    """This supplies a FastAPI test HTTP client"""
+def client(_client: TestClient, db_session: Session) -> Iterator[TestClient]:
+    """This supplies a FastAPI test HTTP client which uses the test's DB session"""
 
     def override_get_db() -> Iterator[Session]:
-        try:
-            yield db_session
-        finally:
-            pass
+        yield db_session
 
     fastapi_app.dependency_overrides[db.get_session] = override_get_db
 
-    return TestClient(fastapi_app)
+    yield _client
+
+    del fastapi_app.dependency_overrides[db.get_session]
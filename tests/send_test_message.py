@@ -37,32 +37,62 @@ Run the ingester:
 Finally, whichever setup you use, send a message:
   PYTHONPATH=. python ./tests/send_test_message.py
 
+To send many BillingEvents over one connection, use --count, eg:
+  PYTHONPATH=. python ./tests/send_test_message.py --count 1000 --workspace test-workspace
+
 """
 
 import uuid
 
+import click
 import pulsar
 from eodhp_utils.pulsar import messages
 
-client = pulsar.Client("pulsar://localhost:6650")
 
-billing_producer = client.create_producer("billing-events", schema=messages.generate_billingevent_schema())
-workspace_producer = client.create_producer("workspace-settings", schema=messages.generate_workspacesettings_schema())
+def on_billing_event_sent(result: pulsar.Result, _msg_id: pulsar.MessageId) -> None:
+    if result != pulsar.Result.Ok:
+        click.echo(f"Failed to send BillingEvent: {result}", err=True)
+
+
+@click.command
+@click.option("--pulsar-url", default="pulsar://localhost:6650")
+@click.option("--count", "-n", default=1, help="Number of BillingEvents to send.")
+@click.option("--workspace", default="test-workspace")
+def main(pulsar_url: str, count: int, workspace: str) -> None:
+    client = pulsar.Client(pulsar_url)
+
+    # Batching lets large --count values be published without a broker round trip per message.
+    billing_producer = client.create_producer(
+        "billing-events",
+        schema=messages.generate_billingevent_schema(),
+        batching_enabled=True,
+        batching_max_messages=1000,
+        batching_max_publish_delay_ms=10,
+    )
+    workspace_producer = client.create_producer(
+        "workspace-settings", schema=messages.generate_workspacesettings_schema()
+    )
+
+    wsmsg = messages.WorkspaceSettings.get_fake()
+    wsmsg.name = workspace
+
+    workspace_producer.send(wsmsg)
 
-wsmsg = messages.WorkspaceSettings.get_fake()
-wsmsg.name = "test-workspace"
+    for _ in range(count):
+        bemsg = messages.BillingEvent(
+            uuid=str(uuid.uuid4()),
+            event_start="2025-01-17T06:42:34.987619",
+            event_end="2025-01-17T06:48:34.987619",
+            sku="testsku",
+            workspace=workspace,
+            quantity=0.0004,
+        )
 
-workspace_producer.send(wsmsg)
+        billing_producer.send_async(bemsg, callback=on_billing_event_sent)
 
-bemsg = messages.BillingEvent(
-    uuid=str(uuid.uuid4()),
-    event_start="2025-01-17T06:42:34.987619",
-    event_end="2025-01-17T06:48:34.987619",
-    sku="testsku",
-    workspace="test-workspace",
-    quantity=0.0004,
-)
+    billing_producer.flush()
+    client.close()
 
-billing_producer.send(bemsg)
 
-client.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+from collections.abc import Iterator
+from datetime import datetime
+from typing import Any
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import Connection
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
+
+from tests.conftest import module_savepoint_session
+from tests.test_api import AUTH_HEADERS, WS1_USAGE
+from tests.test_models import gen_billingitem_data
+
+
+@pytest.fixture(scope="module")
+def aggregation_seed(db_connection: Connection, db_session_factory: sessionmaker[Session]) -> Iterator[None]:
+    """
+    This inserts the BillingEvents used by every parametrization of the time aggregation test
+    once. They're kept out of test_api.py so that other tests don't see them.
+    """
+    with module_savepoint_session(db_connection, db_session_factory) as session:
+        gen_billingitem_data(
+            session,
+            [
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 1, 1, 0, 0, 0),
+                    "event_end": datetime(2025, 1, 1, 1, 0, 0),
+                    "quantity": 0.01,
+                    "sku": "sku1",
+                },
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 1, 1, 2, 0, 0),
+                    "event_end": datetime(2025, 1, 1, 3, 0, 0),
+                    "quantity": 0.1,
+                    "sku": "sku1",
+                },
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 1, 1, 23, 0, 0),
+                    "event_end": datetime(2025, 1, 2, 0, 0, 0),
+                    "quantity": 1,
+                    "sku": "sku1",
+                },
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 1, 2, 2, 0, 0),
+                    "event_end": datetime(2025, 1, 2, 3, 0, 0),
+                    "quantity": 0.2,
+                    "sku": "sku1",
+                },
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 2, 2, 0, 0, 0),
+                    "event_end": datetime(2025, 2, 3, 0, 0, 0),
+                    "quantity": 0.4,
+                    "sku": "sku1",
+                },
+                {
+                    "workspace": "workspace1",
+                    "event_start": datetime(2025, 1, 1, 2, 0, 0),
+                    "event_end": datetime(2025, 1, 1, 3, 0, 0),
+                    "quantity": 0.2,
+                    "sku": "sku2",
+                },
+                {
+                    "workspace": "workspace2",
+                    "event_start": datetime(2025, 1, 1, 2, 0, 0),
+                    "event_end": datetime(2025, 1, 1, 3, 0, 0),
+                    "quantity": 0.5,
+                    "sku": "sku2",
+                },
+            ],
+        )
+        session.commit()
+
+        yield
+
+
+@pytest.mark.parametrize(
+    ("aggregation", "page_size", "results"),
+    [
+        pytest.param(
+            "",
+            100,
+            [
+                [
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku1", "quantity": 0.01},
+                    {"event_start": "2025-01-01T02:00:00Z", "item": "sku1", "quantity": 0.1},
+                    {"event_start": "2025-01-01T02:00:00Z", "item": "sku2", "quantity": 0.2},
+                    {"event_start": "2025-01-01T23:00:00Z", "item": "sku1", "quantity": 1.0},
+                    {"event_start": "2025-01-02T02:00:00Z", "item": "sku1", "quantity": 0.2},
+                    {"event_start": "2025-02-02T00:00:00Z", "item": "sku1", "quantity": 0.4},
+                ],
+                [],
+            ],
+        ),
+        pytest.param(
+            "day",
+            100,
+            [
+                [
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku1", "quantity": 1.11},
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku2", "quantity": 0.2},
+                    {"event_start": "2025-01-02T00:00:00Z", "item": "sku1", "quantity": 0.2},
+                    {"event_start": "2025-02-02T00:00:00Z", "item": "sku1", "quantity": 0.4},
+                ],
+                [],
+            ],
+        ),
+        pytest.param(
+            "day",
+            3,
+            [
+                [
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku1", "quantity": 1.11},
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku2", "quantity": 0.2},
+                    {"event_start": "2025-01-02T00:00:00Z", "item": "sku1", "quantity": 0.2},
+                ],
+                [
+                    {"event_start": "2025-02-02T00:00:00Z", "item": "sku1", "quantity": 0.4},
+                ],
+            ],
+        ),
+        pytest.param(
+            "day",
+            2,
+            [
+                [
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku1", "quantity": 1.11},
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku2", "quantity": 0.2},
+                ],
+                [
+                    {"event_start": "2025-01-02T00:00:00Z", "item": "sku1", "quantity": 0.2},
+                    {"event_start": "2025-02-02T00:00:00Z", "item": "sku1", "quantity": 0.4},
+                ],
+            ],
+        ),
+        pytest.param(
+            "month",
+            100,
+            [
+                [
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku1", "quantity": 1.31},
+                    {"event_start": "2025-01-01T00:00:00Z", "item": "sku2", "quantity": 0.2},
+                    {"event_start": "2025-02-01T00:00:00Z", "item": "sku1", "quantity": 0.4},
+                ],
+                [],
+            ],
+        ),
+    ],
+)
+@pytest.mark.usefixtures("aggregation_seed")
+def test_workspace_usage_data_correctly_time_aggregated(
+    client: TestClient,
+    aggregation: str,
+    page_size: int,
+    results: list[list[dict[str, Any]]],
+) -> None:
+    ############# Test
+    response_pages = []
+    response_jsons = []
+
+    response_pages.append(
+        client.get(
+            f"{WS1_USAGE}?limit={page_size}&time-aggregation={aggregation}",
+            headers=AUTH_HEADERS,
+        )
+    )
+    response_jsons.append(response_pages[0].json())
+
+    after = response_jsons[0][-1]["uuid"]
+    response_pages.append(
+        client.get(
+            f"{WS1_USAGE}?limit={page_size}&after={after}&time-aggregation={aggregation}",
+            headers=AUTH_HEADERS,
+        )
+    )
+    response_jsons.append(response_pages[1].json())
+
+    ############# Behaviour check
+    for page in [0, 1]:
+        assert response_pages[page].status_code == 200
+
+        response_json = response_jsons[page]
+        expected_json = results[page]
+
+        assert len(response_json) == len(expected_json)
+        for response_item, expected_item in zip(response_json, expected_json, strict=True):
+            assert response_item["item"] == expected_item["item"]
+            assert response_item["quantity"] == expected_item["quantity"]
+            assert response_item["event_start"] == expected_item["event_start"]
@@ -0,0 +1,158 @@
+from collections.abc import Iterator
+from datetime import UTC, datetime
+
+import pytest
+from eodhp_utils.pulsar import messages
+from sqlalchemy import Connection
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
+
+from accounting_service import models
+from tests.conftest import add_billing_item, fake_msg, module_savepoint_session
+
+# (sample_time, workspace, rate, sku) for each sample stored by fake_rate_samples.
+_SAMPLE_ROWS = [
+    ("2025-01-01T00:45:00Z", "workspace1", 1, "testsku"),
+    ("2025-01-01T00:55:00Z", "workspace1", 2, "testsku"),
+    ("2025-01-01T01:15:00Z", "workspace1", 3, "testsku"),
+    ("2025-01-01T01:25:00Z", "workspace1", 4, "testsku"),
+    ("2025-01-01T01:50:00Z", "workspace1", 2, "testsku"),
+    ("2025-01-01T02:05:00Z", "workspace1", 1, "testsku"),
+    ("2025-01-01T02:55:00Z", "workspace1", 90, "testsku"),
+    ("2025-01-01T01:35:00Z", "workspace2", 900, "testsku"),
+    ("2025-01-01T01:35:00Z", "workspace1", 900, "nottestsku"),
+]
+
+
+@pytest.fixture(scope="module")
+def fake_rate_samples(
+    db_connection: Connection, db_session_factory: sessionmaker[Session]
+) -> Iterator[list[messages.BillingResourceConsumptionRateSample]]:
+    """
+    This stores several samples around our window of interest, 1am-2am 2025-01-01, once for all
+    tests in this module.
+    """
+    samples = [
+        fake_msg(
+            messages.BillingResourceConsumptionRateSample,
+            sample_time=sample_time,
+            workspace=workspace,
+            rate=rate,
+            sku=sku,
+        )
+        for sample_time, workspace, rate, sku in _SAMPLE_ROWS
+    ]
+
+    with module_savepoint_session(db_connection, db_session_factory) as session:
+        add_billing_item(session, "testsku")
+        add_billing_item(session, "nottestsku")
+        models.BillableResourceConsumptionRateSample.insert_many_from_messages(session, samples)
+        session.commit()
+
+        yield samples
+
+
+def test_round_trip_billingresourceconsumptionratesample_insertfrommessage_retrieve_interval(
+    db_session: Session, fake_rate_samples: list[messages.BillingResourceConsumptionRateSample]
+) -> None:
+    ############# Test
+    found_samples = list(
+        models.BillableResourceConsumptionRateSample.find_data_for_interval(
+            db_session,
+            "workspace1",
+            "testsku",
+            datetime(2025, 1, 1, 1, 0, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 2, 0, 0, tzinfo=UTC),
+        )
+    )
+
+    ############# Behaviour check
+    # The data found should be the last sample before, the last sample after and all samples during
+    # the test period.
+    assert len(found_samples) == 5
+
+    assert found_samples[0].rate == 2
+    assert found_samples[1].rate == 3
+    assert found_samples[2].rate == 4
+    assert found_samples[3].rate == 2
+    assert found_samples[4].rate == 1
+
+
+@pytest.mark.parametrize(
+    ("start", "end", "expected_consumption"),
+    [
+        # Samples for this 10 min window should be:
+        #   * 1:15: 3 (exact start)
+        #   * 1:25: 4 (exact end)
+        # Consumption estimate is (3+4)/2 * 600
+        pytest.param(
+            datetime(2025, 1, 1, 1, 15, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 1, 25, 0, tzinfo=UTC),
+            3.5 * 600,
+        ),
+        # Samples for this 1h window should be:
+        #   * 1:00: 2.25 (interpolated between 2 and 3)
+        #   * 1:15: 3
+        #   * 1:25: 4
+        #   * 1:50: 2
+        #   * 2:00: 1.3333 (interpolated between 2 and 1)
+        # Consumption estimate is 900*(2.25+3)/2 + 600*(3+4)/2 + 1500*(4+2)/2 + 600*(2+1.3333)/2
+        #  = 9962.5
+        pytest.param(
+            datetime(2025, 1, 1, 1, 0, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 2, 0, 0, tzinfo=UTC),
+            9962.5,
+        ),
+        # Samples for this 2 min window should be:
+        #   * 1:15: 3 (before window)
+        #   * 1:19: 3.4 (interpolated window start)
+        #   * 1:21: 3.6 (interpolated window end)
+        #   * 1:25: 4 (after window)
+        # Consumption estimate is 120 * (3.6+3.4)/2
+        pytest.param(
+            datetime(2025, 1, 1, 1, 19, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 1, 21, 0, tzinfo=UTC),
+            420.0,
+        ),
+        # Samples for this 50m window should be:
+        #   * 0:00: No samples
+        #   * 0:45: 1
+        #   * 0:50: 1.5 (interpolated at window end)
+        #   * 0:55: 2 (after window)
+        #
+        # Consumption estimate is 300*(1+1.5)/2 = 375
+        # Note: counted as zero up to first sample
+        pytest.param(
+            datetime(2025, 1, 1, 0, 0, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 0, 50, 0, tzinfo=UTC),
+            375,
+        ),
+        # Samples for this 1h window should be:
+        #   * 2:05: 1 (before window)
+        #   * 2:30: 45.5 (interpolated)
+        #   * 2:55: 90
+        #   * 2:55: 0 (resource assumed destroyed - no later samples)
+        #   * 3:30: 0 (window end)
+        #   * no later samples
+        # Consumption estimate is 25*60*(45.5+90)/2 = 101625.0
+        pytest.param(
+            datetime(2025, 1, 1, 2, 30, 0, tzinfo=UTC),
+            datetime(2025, 1, 1, 3, 30, 0, tzinfo=UTC),
+            101625.0,
+        ),
+    ],
+)
+def test_consumption_estimation_from_billingresourceconsumptionratesamples(
+    db_session: Session,
+    fake_rate_samples: list[messages.BillingResourceConsumptionRateSample],
+    start: datetime,
+    end: datetime,
+    expected_consumption: float,
+) -> None:
+    ############# Test
+    consumption = models.BillableResourceConsumptionRateSample.calculate_consumption_for_interval(
+        db_session, "workspace1", "testsku", start, end
+    )
+
+    ############# Behaviour check
+    assert consumption == expected_consumption
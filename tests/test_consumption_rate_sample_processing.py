@@ -2,21 +2,20 @@ from datetime import UTC, datetime
 from uuid import UUID
 
 from eodhp_utils.pulsar import messages
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.session import Session
 
 from accounting_service import models
 from accounting_service.ingester.messager import ConsumptionSampleRateIngesterMessager
-from tests.conftest import msg_to_pulsar_msg
+from tests.conftest import add_billing_item, fake_msg, msg_to_pulsar_msg
 
 
 def test_message_results_in_sample_in_db(db_session: Session) -> None:
     ############# Setup
-    crs = messages.BillingResourceConsumptionRateSample.get_fake()
+    crs = fake_msg(messages.BillingResourceConsumptionRateSample)
     msg = msg_to_pulsar_msg(ConsumptionSampleRateIngesterMessager, crs)
 
-    db_session.add(models.BillingItem(sku=crs.sku, name="test", unit="GB-h"))
-    db_session.flush()
-    db_session.commit()
+    add_billing_item(db_session, crs.sku)
 
     ############# Test
     messager = ConsumptionSampleRateIngesterMessager()
@@ -26,9 +25,13 @@ def test_message_results_in_sample_in_db(db_session: Session) -> None:
     assert not failures.any_permanent()
     assert not failures.any_temporary()
 
-    obj = db_session.get(models.BillableResourceConsumptionRateSample, UUID(str(crs.uuid)))
+    obj = db_session.get(
+        models.BillableResourceConsumptionRateSample,
+        UUID(str(crs.uuid)),
+        options=[joinedload(models.BillableResourceConsumptionRateSample.item)],
+    )
     assert obj is not None
-    assert str(obj.uuid) == crs.uuid
+    assert obj.uuid == UUID(str(crs.uuid))
     assert obj.sample_time_utc == datetime.fromisoformat(str(crs.sample_time))
     assert str(obj.user) == crs.user
     assert obj.workspace == crs.workspace
@@ -39,14 +42,16 @@ def test_message_results_in_sample_in_db(db_session: Session) -> None:
 def test_messages_across_two_hours_generates_appropriate_billing_events(db_session: Session) -> None:
     ############# Setup
 
-    crs1 = messages.BillingResourceConsumptionRateSample.get_fake(sample_time="2025-01-01T01:30:00Z", rate=2)
-    crs2 = messages.BillingResourceConsumptionRateSample.get_fake(
-        sample_time="2025-01-01T03:30:00Z", rate=4, sku=crs1.sku, workspace=crs1.workspace
+    crs1 = fake_msg(messages.BillingResourceConsumptionRateSample, sample_time="2025-01-01T01:30:00Z", rate=2)
+    crs2 = fake_msg(
+        messages.BillingResourceConsumptionRateSample,
+        sample_time="2025-01-01T03:30:00Z",
+        rate=4,
+        sku=crs1.sku,
+        workspace=crs1.workspace,
     )
 
-    db_session.add(models.BillingItem(sku=crs1.sku, name="test", unit="GB-h"))
-    db_session.flush()
-    db_session.commit()
+    add_billing_item(db_session, crs1.sku)
 
     msg1 = msg_to_pulsar_msg(ConsumptionSampleRateIngesterMessager, crs1)
     msg2 = msg_to_pulsar_msg(ConsumptionSampleRateIngesterMessager, crs2)
@@ -62,7 +67,10 @@ def test_messages_across_two_hours_generates_appropriate_billing_events(db_sessi
     assert not failures2.any_permanent()
     assert not failures2.any_temporary()
 
-    bes = list(models.BillingEvent.find_billing_events(db_session, str(crs1.workspace)))
+    # The limit allows one more than expected so that any extra event is detected.
+    bes = db_session.scalars(
+        models.BillingEvent.find_billing_events_stmt(db_session, str(crs1.workspace), limit=3)
+    ).all()
     assert len(bes) == 2
 
     assert bes[0].event_start_utc == datetime(2025, 1, 1, 1, 0, 0, tzinfo=UTC)
@@ -1,8 +1,10 @@
 from unittest import mock
 from uuid import UUID
 
+import pytest
 from eodhp_utils.pulsar import messages
 from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, sessionmaker
 from sqlalchemy.orm.session import Session
 
 from accounting_service import models
@@ -11,18 +13,28 @@ from accounting_service.ingester.messager import (
     WorkspaceSettingsIngesterMessager,
 )
 from tests.conftest import (
+    add_billing_item,
     bemsg_to_pulsar_msg,
     fake_event_known_times,
+    fake_msg,
     wsmsg_to_pulsar_msg,
 )
 
+# Connecting to this fails immediately because the Unix socket directory doesn't exist. Creating the
+# engine doesn't connect.
+_DEAD_ENGINE = create_engine(
+    "postgresql+psycopg:///nonexistent", connect_args={"host": "/nonexistent-socket-dir", "connect_timeout": 1}
+)
+
 
-def test_message_results_in_billingevent_in_db(db_session: Session) -> None:
+@pytest.mark.parametrize("has_user", [True, False], ids=["with_user", "no_user"])
+def test_message_results_in_billingevent_in_db(db_session: Session, has_user: bool) -> None:
     ############# Setup
     bemsg, start, end = fake_event_known_times()
-    db_session.add(models.BillingItem(sku=bemsg.sku, name="test", unit="GB-h"))
-    db_session.flush()
-    db_session.commit()
+    if not has_user:
+        bemsg.user = None
+
+    add_billing_item(db_session, bemsg.sku)
 
     ############# Test
     messager = AccountingIngesterMessager()
@@ -32,13 +44,16 @@ def test_message_results_in_billingevent_in_db(db_session: Session) -> None:
     assert not failures.any_permanent()
     assert not failures.any_temporary()
 
-    beobj = db_session.get(models.BillingEvent, UUID(str(bemsg.uuid)))
+    beobj = db_session.get(models.BillingEvent, UUID(str(bemsg.uuid)), options=[joinedload(models.BillingEvent.item)])
     assert beobj is not None
-    assert str(beobj.uuid) == bemsg.uuid
+    assert beobj.uuid == UUID(str(bemsg.uuid))
 
     assert beobj.event_start_utc == start
     assert beobj.event_end_utc == end
-    assert str(beobj.user) == bemsg.user
+    if has_user:
+        assert str(beobj.user) == bemsg.user
+    else:
+        assert beobj.user is None
     assert beobj.workspace == bemsg.workspace
     assert beobj.quantity == bemsg.quantity
     assert beobj.item.sku == bemsg.sku
@@ -47,9 +62,7 @@ def test_message_results_in_billingevent_in_db(db_session: Session) -> None:
 def test_two_messages_same_uuid_results_in_one_billingevent_in_db(db_session: Session) -> None:
     ############# Setup
     bemsg, _start, _end = fake_event_known_times()
-    db_session.add(models.BillingItem(sku=bemsg.sku, name="test", unit="GB-h"))
-    db_session.flush()
-    db_session.commit()
+    add_billing_item(db_session, bemsg.sku)
 
     ############# Test
     messager = AccountingIngesterMessager()
@@ -72,32 +85,33 @@ def test_two_messages_same_uuid_results_in_one_billingevent_in_db(db_session: Se
     assert beobj.quantity == 1
 
 
-def test_message_with_no_user_results_in_billingevent_in_db(db_session: Session) -> None:
+def test_redelivered_message_does_not_reach_db(db_session: Session) -> None:
     ############# Setup
-    bemsg = messages.BillingEvent.get_fake()
-    bemsg.user = None
-
-    db_session.add(models.BillingItem(sku=bemsg.sku, name="test", unit="GB-h"))
-    db_session.flush()
-    db_session.commit()
+    bemsg, _start, _end = fake_event_known_times()
+    add_billing_item(db_session, bemsg.sku)
 
     ############# Test
     messager = AccountingIngesterMessager()
-    failures = messager.consume(bemsg_to_pulsar_msg(bemsg))
+
+    with mock.patch.object(
+        models.BillingEvent, "insert_from_message", wraps=models.BillingEvent.insert_from_message
+    ) as insert_mock:
+        failures1 = messager.consume(bemsg_to_pulsar_msg(bemsg))
+        failures2 = messager.consume(bemsg_to_pulsar_msg(bemsg))
 
     ############# Behaviour check
-    assert not failures.any_permanent()
-    assert not failures.any_temporary()
+    assert not failures1.any_permanent()
+    assert not failures1.any_temporary()
 
-    beobj = db_session.get(models.BillingEvent, UUID(str(bemsg.uuid)))
-    assert beobj is not None
-    assert str(beobj.uuid) == bemsg.uuid
-    assert beobj.user is None
+    assert not failures2.any_permanent()
+    assert not failures2.any_temporary()
+
+    assert insert_mock.call_count == 1
 
 
 def test_message_with_unknown_sku_creates_billingitem(db_session: Session) -> None:
     ############# Setup
-    bemsg = messages.BillingEvent.get_fake()
+    bemsg = fake_msg(messages.BillingEvent)
 
     ############# Test
     messager = AccountingIngesterMessager()
@@ -107,14 +121,14 @@ def test_message_with_unknown_sku_creates_billingitem(db_session: Session) -> No
     assert not failures.any_permanent()
     assert not failures.any_temporary()
 
-    beobj = db_session.get(models.BillingEvent, UUID(str(bemsg.uuid)))
+    beobj = db_session.get(models.BillingEvent, UUID(str(bemsg.uuid)), options=[joinedload(models.BillingEvent.item)])
     assert beobj is not None
     assert beobj.item.sku == bemsg.sku
 
 
 def test_message_with_invalid_uuid_produces_permanent_failure() -> None:
     ############# Setup
-    bemsg = messages.BillingEvent.get_fake()
+    bemsg = fake_msg(messages.BillingEvent)
     bemsg.uuid = "abc"
 
     ############# Test
@@ -126,11 +140,9 @@ def test_message_with_invalid_uuid_produces_permanent_failure() -> None:
 
 
 def test_db_operational_error_produces_temporary_failure() -> None:
-    engine = create_engine("postgresql+psycopg://localhost:1/nonexistent")
-    with mock.patch("accounting_service.ingester.messager.db.engine", engine):
-        # session = scoped_session(sessionmaker(bind=engine))
+    with mock.patch("accounting_service.ingester.messager.db.SessionLocal", sessionmaker(bind=_DEAD_ENGINE)):
         ############# Setup
-        bemsg = messages.BillingEvent.get_fake()
+        bemsg = fake_msg(messages.BillingEvent)
 
         ############# Test
         messager = AccountingIngesterMessager()
@@ -2,12 +2,12 @@ import io
 from datetime import UTC, datetime
 from decimal import Decimal
 
-from faker import Faker
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 import accounting_service.db
 from accounting_service.models import BillingItem, BillingItemPrice
+from tests.conftest import FAKER
 
 
 def test_model_creation() -> None:
@@ -17,8 +17,7 @@ def test_model_creation() -> None:
 def test_item_and_price_creation_via_config_file_results_in_correct_object_in_db(
     db_session: Session,
 ) -> None:
-    faker = Faker()
-    test_sku = faker.name()
+    test_sku = FAKER.name()
 
     test_config = f"""---
 items:
@@ -52,8 +51,7 @@ prices:
 
 
 def test_item_and_price_update_via_config_file_results_in_correct_object_in_db(db_session: Session) -> None:
-    faker = Faker()
-    test_sku = faker.name()
+    test_sku = FAKER.name()
 
     test_config = f"""---
 items: